@@ -15,13 +15,15 @@
 # 51 Franklin St - Fifth Floor, Boston, MA 02110-1301 USA.
 
 import collections
-import glob
+import functools
+import operator
 import re
 import sys
-import _thread
+import threading
 import time
 import traceback
 import types
+import weakref
 import os
 import random
 
@@ -36,6 +38,110 @@ _g_device_classes = []
 _g_device_id_class = {} # device id => device class
 
 _g_plugin_dir = os.path.join(os.path.dirname(__file__), "remotedevices_plugins")
+_g_plugins_cache = {"mtime": None, "names": None} # avail_plugins() result
+_g_api_cache = weakref.WeakKeyDictionary() # device object class -> api methods
+_g_loaded_plugins = set() # plugins successfully loaded by load_all_plugins
+_g_failed_plugins = {} # plugin -> time of last failed import
+_PLUGIN_RETRY_DELAY = 60 # seconds before retrying a failed plugin import
+
+_MATCH_FIELDS = ("id", "type", "sw", "hw", "display")
+
+# Patterns that cannot be embedded in a combined regexp without
+# changing their meaning: numbered backreferences, absolute anchors,
+# lookarounds, global inline flags, conditional groups, and atomic
+# groups and possessive quantifiers that could consume a field
+# separator without backtracking.
+_UNION_UNSAFE = re.compile(r"\\[1-9AZ]|\(\?[=!<>(]|\(\?[aiLmsux]+\)|[*+?}]\+")
+
+@functools.lru_cache(maxsize=256)
+def _compile(pattern):
+    return re.compile(pattern)
+
+@functools.lru_cache(maxsize=256)
+def _compile_union(patterns):
+    """returns a regexp that matches key strings (see _info_keystr) of
+    devices whose every field may match corresponding pattern, or None
+    if patterns cannot be combined. A match must be verified field by
+    field, but a mismatch rejects the device."""
+    if any(_UNION_UNSAFE.search(p) for p in patterns):
+        return None
+    try:
+        return re.compile("".join("(?:%s)[^\n]*\n" % (p,) for p in patterns),
+                          re.MULTILINE)
+    except re.error:
+        return None
+
+_REGEXP_QUANTIFIER = re.compile(r"\{\d*(,\d*)?\}")
+_REGEXP_FLAGS = re.compile(r"\(\?[aiLmsux-]")
+
+@functools.lru_cache(maxsize=256)
+def _required_literal(pattern):
+    """returns the longest literal string of at least 3 characters
+    that every match of pattern contains, or None. Only literals
+    outside groups, character classes and alternatives are found."""
+    if _REGEXP_FLAGS.search(pattern):
+        return None
+    runs = []
+    run = ""
+    depth = 0
+    pos = 0
+    while pos < len(pattern):
+        c = pattern[pos]
+        quantifier = c == "{" and _REGEXP_QUANTIFIER.match(pattern, pos)
+        if c == "\\":
+            runs.append(run)
+            run = ""
+            pos += 2
+            continue
+        elif c == "[":
+            runs.append(run)
+            run = ""
+            pos += 1
+            if pattern[pos:pos+1] == "^":
+                pos += 1
+            if pattern[pos:pos+1] == "]":
+                pos += 1
+            while pos < len(pattern) and pattern[pos] != "]":
+                if pattern[pos] == "\\":
+                    pos += 1
+                pos += 1
+        elif c == "(":
+            runs.append(run)
+            run = ""
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth > 0:
+            pass
+        elif c == "|":
+            return None
+        elif c in "*?" or quantifier:
+            # last character is optional or repeated
+            runs.append(run[:-1])
+            run = ""
+            if quantifier:
+                pos = quantifier.end() - 1
+        elif c == "+":
+            runs.append(run)
+            run = ""
+        elif c in ".^$\n":
+            runs.append(run)
+            run = ""
+        else:
+            run += c
+        pos += 1
+    runs.append(run)
+    longest = max(runs, key=len)
+    if len(longest) < 3:
+        return None
+    return longest
+
+def _info_keystr(info):
+    """returns DeviceInfo fields as newline-terminated lines, or None if
+    a field is not a single-line string"""
+    if any(not isinstance(field, str) or "\n" in field for field in info):
+        return None
+    return "".join("%s\n" % (field,) for field in info)
 
 def register_device_class(deviceClassInstance):
     _g_device_classes.append(deviceClassInstance)
@@ -50,24 +156,59 @@ def list_plugins():
     return [plugin_name(dc) for dc in _g_device_classes]
 
 def load_plugin(deviceClassName):
-    __import__("remotedevices_plugins." + deviceClassName)
+    moduleName = "remotedevices_plugins." + deviceClassName
+    if moduleName in sys.modules:
+        return
+    __import__(moduleName)
 
 def load_all_plugins():
+    now = time.time()
     for p in avail_plugins():
+        if p in _g_loaded_plugins:
+            continue
+        failed = _g_failed_plugins.get(p)
+        if failed is not None and now - failed < _PLUGIN_RETRY_DELAY:
+            continue
         try:
             load_plugin(p)
+            _g_loaded_plugins.add(p)
+            _g_failed_plugins.pop(p, None)
         except Exception as e:
+            _g_failed_plugins[p] = now
             daemon_log("plugin %s import failed: %s" % (p, e))
 
 def avail_plugins():
-    plugins = [os.path.basename(f)[:-3]
-               for f in glob.glob(os.path.join(_g_plugin_dir, "*.py"))
-               if not os.path.basename(f).startswith("_")]
-    return plugins
+    try:
+        mtime = os.stat(_g_plugin_dir).st_mtime
+    except OSError:
+        return []
+    if mtime != _g_plugins_cache["mtime"]:
+        _g_plugins_cache["names"] = [
+            entry.name[:-3]
+            for entry in os.scandir(_g_plugin_dir)
+            if (entry.name.endswith(".py") and
+                not entry.name.startswith(("_", ".")) and
+                entry.is_file())]
+        _g_plugins_cache["mtime"] = mtime
+    return list(_g_plugins_cache["names"])
 
 def plugin_dir():
     return _g_plugin_dir
 
+def _api_methods(obj, attrs):
+    """returns {method-name: argument-names} of public methods and
+    functions among attributes attrs of obj"""
+    methods = {}
+    for attr in attrs:
+        if attr.startswith("_"):
+            continue
+        m = getattr(obj, attr)
+        if isinstance(m, types.MethodType):
+            methods[attr] = m.__func__.__code__.co_varnames[1:m.__func__.__code__.co_argcount]
+        elif isinstance(m, types.FunctionType):
+            methods[attr] = m.__code__.co_varnames[1:m.__code__.co_argcount]
+    return methods
+
 class DeviceClass(object):
     """DeviceClass is offers methods for
 
@@ -113,18 +254,27 @@ class Devices(object):
     """
     """
     def __init__(self):
-        self._lock = _thread.allocate_lock()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
         self.reset()
         self.rescan()
 
     def reset(self):
-        self._devinfo = {} # serial -> device, deviceInfo
-        self._refcount = {} # serial -> int
-        self._acquirer = {} # acquirer-id -> (serial -> list-of-timestamps)
-        self._infos = {} # deviceInfo -> serial
+        with self._cond:
+            self._devinfo = {} # serial -> device, deviceInfo
+            self._refcount = {} # serial -> int
+            self._acquirer = collections.defaultdict(
+                lambda: collections.defaultdict(collections.deque))
+                # acquirer-id -> (serial -> deque-of-timestamps)
+            self._key_holders = collections.defaultdict(collections.deque)
+                # serial -> deque-of-acquirer-ids, latest acquirer last
+            self._info_keystr = {} # serial -> key string for _compile_union
+            self._free = set() # serials that can be acquired
+            # blocked acquire() calls find no matching devices anymore
+            self._cond.notify_all()
 
     def rescan(self):
-        with self._lock:
+        with self._cond:
             serialNumbers = set([])
             for dc in _g_device_classes:
                 try:
@@ -144,37 +294,73 @@ class Devices(object):
             if blacklist:
                 serialNumbers = serialNumbers - set(blacklist)
 
+            current = set(self._devinfo)
+            newSerialNumbers = serialNumbers - current
+            goneSerialNumbers = current - serialNumbers
+            found = []
+
             # find new devices
-            for serialNumber in sorted(serialNumbers):
-                if serialNumber in self._devinfo:
-                    daemon_log('rescan kept "%s"' % (serialNumber,))
-                else:
-                    try:
-                        self._wolock_add(serialNumber)
-                        daemon_log('rescan found "%s"' % (serialNumber,))
-                    except Exception as e:
-                        daemon_log('rescan found but failed connecting "%s": %s' % (serialNumber, e))
+            for serialNumber in newSerialNumbers:
+                try:
+                    self._wolock_add(serialNumber)
+                    found.append(serialNumber)
+                except Exception as e:
+                    daemon_log('rescan found but failed connecting "%s": %s' % (serialNumber, e))
 
             # forget detached devices
-            for serialNumber in list(self._devinfo.keys()):
-                if serialNumber not in serialNumbers:
-                    self._wolock_remove(serialNumber)
-                    daemon_log('rescan forgot "%s"' % (serialNumber,))
+            for serialNumber in goneSerialNumbers:
+                self._wolock_remove(serialNumber, log=False)
+
+            daemon_log('rescan: +%s =%s -%s: found=%s forgot=%s' % (
+                len(found), len(current) - len(goneSerialNumbers),
+                len(goneSerialNumbers), sorted(found), sorted(goneSerialNumbers)))
 
     def match(self, **matchArgs):
-        with self._lock:
+        with self._cond:
             return self._wolock_match(**matchArgs)
 
     def _wolock_match(self, **matchArgs):
-        matchingSerials = set([
-            self._infos[i] for i in list(self._infos.keys()) if
-            (not "id" in matchArgs or re.match(matchArgs["id"], i.id)) and
-            (not "type" in matchArgs or re.match(matchArgs["type"], i.type)) and
-            (not "sw" in matchArgs or re.match(matchArgs["sw"], i.sw)) and
-            (not "hw" in matchArgs or re.match(matchArgs["hw"], i.hw)) and
-            (not "display" in matchArgs or re.match(matchArgs["display"], i.display)) and
-            (not "free" in matchArgs or (matchArgs["free"].lower() == str(self.available(self._infos[i])).lower())) and
-            (not "busy" in matchArgs or (matchArgs["busy"].lower() == str(not self.available(self._infos[i])).lower()))])
+        # prepare everything that does not depend on the device
+        checks = [(operator.attrgetter(field), _compile(matchArgs[field]).match)
+                  for field in _MATCH_FIELDS if field in matchArgs]
+        # only the longest literal is tested, one "in" per device costs
+        # less than testing all of them
+        literals = [_required_literal(matchArgs[field])
+                    for field in _MATCH_FIELDS if field in matchArgs]
+        literals = [l for l in literals if l is not None]
+        literal = max(literals, key=len) if literals else None
+        if len(checks) >= 2:
+            # a single field is matched faster without the combined regexp
+            union = _compile_union(tuple(matchArgs.get(field, "")
+                                         for field in _MATCH_FIELDS))
+        else:
+            union = None
+        for arg in ("free", "busy"):
+            if arg in matchArgs and matchArgs[arg].lower() not in ("true", "false"):
+                return set() # neither true nor false matches no device
+        wantFree = wantBusy = None
+        if "free" in matchArgs:
+            wantFree = matchArgs["free"].lower() == "true"
+        if "busy" in matchArgs:
+            wantBusy = matchArgs["busy"].lower() == "true"
+        matchingSerials = set()
+        for serial, keystr in self._info_keystr.items():
+            if wantFree is not None and (serial in self._free) != wantFree:
+                continue
+            if wantBusy is not None and (serial not in self._free) != wantBusy:
+                continue
+            if keystr is not None:
+                # a cheap substring test rejects most devices before regexps
+                if literal is not None and not literal in keystr:
+                    continue
+                if union is not None and not union.match(keystr):
+                    continue
+            i = self._devinfo[serial][1]
+            for getfield, match in checks:
+                if not match(getfield(i)):
+                    break
+            else:
+                matchingSerials.add(serial)
         return matchingSerials
 
     def available(self, key):
@@ -182,11 +368,10 @@ class Devices(object):
         Returns True if object with id KEY can be acquired.
         """
         self._validate(key)
-        maxRefCount = _g_device_id_class[key].maxRefCount()
-        return (maxRefCount == -1 or self._refcount[key] < maxRefCount)
+        return key in self._free
 
     def all(self):
-        return list(self._refcount.keys())
+        return list(self._refcount)
 
     def acquire(self, block=True, acquirer="", **matchArgs):
         """
@@ -216,26 +401,27 @@ class Devices(object):
         """
         if acquirer == None:
             acquirer = ""
-        while True:
-            with self._lock:
+        with self._cond:
+            while True:
                 matchingSerials = self._wolock_match(**matchArgs)
                 if not matchingSerials:
                     return None
-                matchingAvailable = [s for s in matchingSerials if self.available(s)]
+                matchingAvailable = matchingSerials & self._free
                 if matchingAvailable:
                     key = random.choice(tuple(matchingAvailable))
                     matchingAvailable.remove(key)
                     self._wolock_acquire(key, acquirer)
                     break
-            if not block:
-                return None
-            daemon_log("acquire blocked")
-            time.sleep(1)
+                if not block:
+                    return None
+                daemon_log("acquire blocked")
+                # woken up when devices are added, released or removed
+                self._cond.wait()
         daemon_log('%s acquired "%s"' % (repr(acquirer), key))
         return key
 
     def info(self, key):
-        with self._lock:
+        with self._cond:
             self._validate(key)
             return dict(self._devinfo[key][1]._asdict())
 
@@ -244,50 +430,60 @@ class Devices(object):
             raise ValueError('unknown device "%s"' % (key,))
 
     def _wolock_acquire(self, key, acquirer=""):
-        self._refcount[key] += 1
-        timestamp = time.time()
-        if acquirer in self._acquirer:
-            if key in self._acquirer[acquirer]:
-                self._acquirer[acquirer][key].append(timestamp)
-            else:
-                self._acquirer[acquirer][key] = [timestamp]
-        else:
-            self._acquirer[acquirer] = {key: [timestamp]}
+        refcount = self._refcount[key] + 1
+        self._refcount[key] = refcount
+        maxRefCount = _g_device_id_class[key].maxRefCount()
+        if maxRefCount != -1 and refcount >= maxRefCount:
+            self._free.discard(key)
+        timestamps = self._acquirer[acquirer][key]
+        if not timestamps:
+            self._key_holders[key].append(acquirer)
+        timestamps.append(time.time())
 
     def _wolock_release(self, key, acquirer=""):
-        if self._refcount[key] == 0:
+        refcount = self._refcount[key]
+        if refcount == 0:
             raise ValueError('device "%s" not acquired' % (key,))
         released_ts = time.time()
         if acquirer == None:
             # automatically find acquirer
-            for acqid in self._acquirer:
-                if len(self._acquirer[acqid].get(key, [])) > 0:
-                    acquirer = acqid
-                    break
-        if (acquirer not in self._acquirer or
-            key not in self._acquirer[acquirer] or
-            len(self._acquirer[acquirer][key]) == 0):
+            holders = self._key_holders.get(key)
+            if holders:
+                acquirer = holders[-1]
+        # use get() to avoid creating entries in defaultdicts
+        acquired = self._acquirer.get(acquirer)
+        timestamps = acquired.get(key) if acquired else None
+        if not timestamps:
             raise ValueError('"%s" has not acquired "%s"' % (acquirer, key))
-        self._refcount[key] -= 1
-        acquired_ts = self._acquirer[acquirer][key].pop()
-        if len(self._acquirer[acquirer][key]) == 0:
-            del self._acquirer[acquirer][key]
-            if not self._acquirer[acquirer]: # empty dict
+        refcount -= 1
+        self._refcount[key] = refcount
+        maxRefCount = _g_device_id_class[key].maxRefCount()
+        if maxRefCount == -1 or refcount < maxRefCount:
+            self._free.add(key)
+        acquired_ts = timestamps.pop()
+        if len(timestamps) == 0:
+            del acquired[key]
+            if not acquired: # empty dict
                 del self._acquirer[acquirer]
+            holders = self._key_holders[key]
+            holders.remove(acquirer)
+            if not holders:
+                del self._key_holders[key]
         daemon_log('%s released "%s" after %.3f s' % (
             repr(acquirer), key, released_ts - acquired_ts))
+        self._cond.notify_all()
 
     def release(self, key, acquirer=None):
-        with self._lock:
+        with self._cond:
             self._validate(key)
             self._wolock_release(key, acquirer)
 
     def release_all(self, acquirer):
         # release all keys acquired by the acquirer
-        if not acquirer in self._acquirer:
-            raise ValueError('unknown acquirer "%s"' % (acquirer,))
-        with self._lock:
-            for key in list(self._acquirer[acquirer].keys()):
+        with self._cond:
+            if not acquirer in self._acquirer:
+                raise ValueError('unknown acquirer "%s"' % (acquirer,))
+            for key in tuple(self._acquirer[acquirer]):
                 self._wolock_release(key, acquirer)
 
     def acquired(self, key):
@@ -297,14 +493,14 @@ class Devices(object):
             raise ValueError('device "%s" not acquired' % (key,))
 
     def acquirers(self):
-        return sorted(self._acquirer.keys())
+        return sorted(self._acquirer)
 
     def acquisitions(self):
         retval = []
-        with self._lock:
-            for acquirer in sorted(self._acquirer.keys()):
+        with self._cond:
+            for acquirer in sorted(self._acquirer):
                 for key in self._acquirer[acquirer]:
-                    timestamps = self._acquirer[acquirer][key]
+                    timestamps = list(self._acquirer[acquirer][key])
                     retval.append((acquirer, key, timestamps))
         return retval
 
@@ -313,13 +509,17 @@ class Devices(object):
         d, i = _g_device_id_class[serialNumber].adopt(serialNumber)
         self._devinfo[serialNumber] = d, i
         self._refcount[serialNumber] = 0
-        self._infos[i] = serialNumber
+        maxRefCount = _g_device_id_class[serialNumber].maxRefCount()
+        if maxRefCount == -1 or maxRefCount > 0:
+            self._free.add(serialNumber)
+        self._info_keystr[serialNumber] = _info_keystr(i)
+        self._cond.notify_all()
 
     def add(self, serialNumber):
         if not serialNumber in _g_device_id_class:
             raise ValueError('device "%s" not found' % (serialNumber,))
 
-        with self._lock:
+        with self._cond:
             if serialNumber in blacklist:
                 raise ValueError('device "%s" blacklisted' % (serialNumber,))
             elif serialNumber in self._refcount:
@@ -331,20 +531,28 @@ class Devices(object):
 
     def api(self, serialNumber):
         self._validate(serialNumber)
-        if serialNumber in self._devinfo:
-            d, i = self._devinfo[serialNumber]
-        doc = []
-        for attr in sorted(dir(d)):
-            m = getattr(d, attr)
-            if isinstance(m, types.MethodType) and not attr.startswith("_"):
-                doc.append((attr, m.__func__.__code__.co_varnames[1:m.__func__.__code__.co_argcount]))
-            elif isinstance(m, types.FunctionType) and not attr.startswith("_"):
-                doc.append((attr, m.__code__.co_varnames[1:m.__code__.co_argcount]))
-        methods = ["%s(%s)" % (m, ", ".join(args)) for m, args in doc]
+        d, i = self._devinfo[serialNumber]
+        # class methods are introspected once per class, only attributes
+        # set on the instance itself (like d.adb) are checked every time
+        cls = type(d)
+        classMethods = _g_api_cache.get(cls)
+        if classMethods is None:
+            classMethods = _api_methods(cls, dir(cls))
+            _g_api_cache[cls] = classMethods
+        instanceAttrs = [attr for attr in getattr(d, "__dict__", ())
+                         if not attr.startswith("_")]
+        if instanceAttrs:
+            doc = dict((m, args) for m, args in classMethods.items()
+                       if not m in instanceAttrs)
+            doc.update(_api_methods(d, instanceAttrs))
+        else:
+            doc = classMethods
+        methods = ["%s(%s)" % (m, ", ".join(doc[m])) for m in sorted(doc)]
         return "\n".join(methods)
 
-    def _wolock_remove(self, serialNumber):
-        self._validate(serialNumber)
+    def _wolock_remove(self, serialNumber, log=True):
+        # without lock device remove. self._lock must be taken and
+        # serialNumber validated by the caller
         if self._refcount[serialNumber] > 0:
             self._wolock_release(serialNumber, None)
         d, i = self._devinfo[serialNumber]
@@ -352,25 +560,28 @@ class Devices(object):
         d, i = self._devinfo[serialNumber]
         del self._devinfo[serialNumber]
         del self._refcount[serialNumber]
-        del self._infos[i]
-        daemon_log('removed "%s"' % (serialNumber,))
+        self._free.discard(serialNumber)
+        del self._info_keystr[serialNumber]
+        if log:
+            daemon_log('removed "%s"' % (serialNumber,))
+        self._cond.notify_all()
 
     def remove(self, serialNumber, force=False):
-        with self._lock:
+        with self._cond:
             self._validate(serialNumber)
             if self._refcount[serialNumber] > 0 and not force:
                 raise ValueError('device "%s" is busy' % (serialNumber,))
             self._wolock_remove(serialNumber)
 
     def blacklist_include(self, serialNumber):
-        with self._lock:
+        with self._cond:
             if serialNumber in blacklist:
                 raise ValueError('device "%s" already blacklisted' % (serialNumber,))
             else:
                 blacklist.append(serialNumber)
 
     def blacklist_exclude(self, serialNumber):
-        with self._lock:
+        with self._cond:
             if not serialNumber in blacklist:
                 raise ValueError('device "%s" not blacklisted' % (serialNumber,))
             blacklist.remove(serialNumber)
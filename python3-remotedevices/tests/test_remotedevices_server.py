@@ -0,0 +1,167 @@
+# fMBT, free Model Based Testing tool
+# Copyright (c) Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU Lesser General Public License,
+# version 2.1, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin St - Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Tests for remotedevices_server.Devices.
+
+Run: python3 -m unittest discover -s python3-remotedevices/tests
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+_srcdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path[:0] = [os.path.join(_srcdir, "python3share"),
+                os.path.join(_srcdir, "python3-remotedevices")]
+
+import remotedevices_server
+
+class FakeDevices(remotedevices_server.DeviceClass):
+    def __init__(self, deviceIds, maxRefCount=1):
+        remotedevices_server.DeviceClass.__init__(self, maxRefCount)
+        self._deviceIds = deviceIds
+
+    def rescan(self):
+        return list(self._deviceIds)
+
+    def adopt(self, deviceId):
+        return object(), remotedevices_server.DeviceInfo(
+            id=deviceId, type="android", sw="4.4.2", hw="hw", display="480x800")
+
+    def abandon(self, deviceInfo, deviceObj):
+        pass
+
+def fake_devices(deviceIds, maxRefCount=1):
+    """returns Devices that contains only deviceIds"""
+    remotedevices_server._g_device_classes[:] = [
+        FakeDevices(deviceIds, maxRefCount)]
+    return remotedevices_server.Devices()
+
+class TestMatch(unittest.TestCase):
+    def setUp(self):
+        self.devices = fake_devices(["abc"])
+
+    def test_match_fields(self):
+        self.assertEqual(self.devices.match(id="ab", sw=r"4\.4"), set(["abc"]))
+        self.assertEqual(self.devices.match(display="480x800$"), set(["abc"]))
+        self.assertEqual(self.devices.match(type="tab|ios"), set())
+        self.assertEqual(self.devices.match(id="abc$", type="android$"), set(["abc"]))
+
+    def test_match_patterns_not_combinable(self):
+        # possessive quantifiers, atomic groups and conditional groups
+        # must not be joined into a single regexp over all fields
+        for matchArgs in [dict(sw=r"4\.[^ ]*+"),
+                          dict(sw=r"4\.[^ ]++"),
+                          dict(display=r"(?>[^,]*)"),
+                          dict(display=r"[^,]{3,}+"),
+                          dict(id="(a)?bc", type="(x)?(?(1)y|android)"),
+                          dict(id=r"(a)b\1?"),
+                          dict(id="(?i)ABC")]:
+            self.assertEqual(self.devices.match(**matchArgs), set(["abc"]),
+                             matchArgs)
+
+    def test_match_free_busy(self):
+        self.assertEqual(self.devices.match(free="True"), set(["abc"]))
+        self.assertEqual(self.devices.match(busy="True"), set())
+        self.devices.acquire(acquirer="test")
+        self.assertEqual(self.devices.match(free="true"), set())
+        self.assertEqual(self.devices.match(busy="true"), set(["abc"]))
+        self.assertEqual(self.devices.match(free="bogus"), set())
+
+class TestAcquire(unittest.TestCase):
+    def setUp(self):
+        self.devices = fake_devices(["abc"])
+
+    def _blocked_acquire(self):
+        self.assertEqual(self.devices.acquire(acquirer="a"), "abc")
+        result = []
+        t = threading.Thread(
+            target=lambda: result.append(self.devices.acquire(acquirer="b")))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        return t, result
+
+    def test_release_wakes_blocked_acquire(self):
+        t, result = self._blocked_acquire()
+        self.devices.release("abc")
+        t.join(3)
+        self.assertEqual(result, ["abc"])
+
+    def test_reset_wakes_blocked_acquire(self):
+        t, result = self._blocked_acquire()
+        self.devices.reset()
+        t.join(3)
+        self.assertEqual(result, [None])
+
+    def test_acquire_shared_device(self):
+        devices = fake_devices(["shared"], maxRefCount=2)
+        self.assertEqual(devices.acquire(block=False, acquirer="a"), "shared")
+        self.assertEqual(devices.match(free="true"), set(["shared"]))
+        self.assertEqual(devices.acquire(block=False, acquirer="b"), "shared")
+        self.assertEqual(devices.match(free="true"), set())
+        self.assertEqual(devices.match(busy="true"), set(["shared"]))
+        self.assertEqual(devices.acquire(block=False, acquirer="c"), None)
+        devices.release("shared", "a")
+        self.assertEqual(devices.match(free="true"), set(["shared"]))
+        self.assertEqual(devices.acquire(block=False, acquirer="c"), "shared")
+        self.assertEqual(devices.acquire(block=False, acquirer="d"), None)
+
+class TestRelease(unittest.TestCase):
+    def holders(self, devices):
+        """returns [(acquirer, key, acquisition-count)]"""
+        return [(acquirer, key, len(timestamps))
+                for acquirer, key, timestamps in devices.acquisitions()]
+
+    def test_release_without_acquirer_refcount_2(self):
+        devices = fake_devices(["shared"], maxRefCount=2)
+        devices.acquire(block=False, acquirer="a")
+        devices.acquire(block=False, acquirer="b")
+        devices.release("shared")
+        # the latest acquirer is released first
+        self.assertEqual(self.holders(devices), [("a", "shared", 1)])
+        devices.release("shared")
+        self.assertEqual(self.holders(devices), [])
+        self.assertRaises(ValueError, devices.release, "shared")
+
+    def test_release_without_acquirer_unlimited(self):
+        devices = fake_devices(["shared"], maxRefCount=-1)
+        for acquirer in ["a", "b", "a", "c"]:
+            self.assertEqual(devices.acquire(block=False, acquirer=acquirer),
+                             "shared")
+        self.assertEqual(self.holders(devices), [
+            ("a", "shared", 2), ("b", "shared", 1), ("c", "shared", 1)])
+        devices.release("shared")
+        self.assertEqual(self.holders(devices), [
+            ("a", "shared", 2), ("b", "shared", 1)])
+        devices.release("shared", "a")
+        self.assertEqual(self.holders(devices), [
+            ("a", "shared", 1), ("b", "shared", 1)])
+        devices.release("shared")
+        self.assertEqual(self.holders(devices), [("a", "shared", 1)])
+        devices.acquire(block=False, acquirer="b")
+        devices.release("shared")
+        self.assertEqual(self.holders(devices), [("a", "shared", 1)])
+        devices.release("shared")
+        self.assertEqual(self.holders(devices), [])
+        self.assertRaises(ValueError, devices.release, "shared")
+        self.assertEqual(devices.acquirers(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,18 +2,15 @@
 
 import os
 import subprocess
-import _thread
+import threading
 
 import fmbt
 
 last_bg_pid = 0
 
 def readlines_to_adapterlog(file_obj, prefix):
-    while 1:
-        line = file_obj.readline()
-        if not line:
-            break
-        fmbt.adapterlog("%s%s" % (prefix, line))
+    for line in iter(file_obj.readline, b""):
+        fmbt.adapterlog("%s%s" % (prefix, line.decode(errors="replace").rstrip("\r\n")))
 
 def soe(cmd, stdin="", cwd=None, env=None):
     """Run cmd, return (status, stdout, stderr)"""
@@ -44,6 +41,10 @@ def bg(cmd):
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
     fmbt.fmbtlog("%s: bg pid %s" % (fmbt.actionName(), p.pid))
-    _thread.start_new_thread(readlines_to_adapterlog, (p.stdout, "%s out: " % (p.pid,)))
-    _thread.start_new_thread(readlines_to_adapterlog, (p.stderr, "%s err: " % (p.pid,)))
+    threading.Thread(target=readlines_to_adapterlog,
+                     args=(p.stdout, "%s out: " % (p.pid,)),
+                     daemon=True).start()
+    threading.Thread(target=readlines_to_adapterlog,
+                     args=(p.stderr, "%s err: " % (p.pid,)),
+                     daemon=True).start()
     last_bg_pid = p.pid
@@ -1,4 +1,5 @@
-import commands
+import shlex
+import subprocess
 
 testconf_contents = []
 
@@ -18,25 +19,26 @@ def iModel(description):
         model+= 'T(ostate, "oNop", dead)'
     else:
         raise Exception("teststeps.py: don't know how to make model '%s'" % (description,))
-    modelcmd = "fmbt-gt -o model.lsts 'P(istate,p) -> %s'" % (model,)
-    s,o = commands.getstatusoutput(modelcmd)
-    if s != 0:
-        raise Exception("teststeps.py: fmbt-gt error, try: \"%s\"" % (modelcmd,))
+    modelcmd = ["fmbt-gt", "-o", "model.lsts", "P(istate,p) -> %s" % (model,)]
+    r = subprocess.run(modelcmd, capture_output=True, text=True)
+    if r.returncode != 0:
+        raise Exception("teststeps.py: fmbt-gt error, try: %s\n%s" % (
+            shlex.join(modelcmd), r.stderr))
     testconf_contents = ['model = "model.lsts"']
 
 def iActions(i=0, o=0):
     """
     adds extra actions to model.lsts
     """
-    model = ''
-    for n in xrange(i):
-        model += 'T(unreachable, "iExtra%s", istate)' % (n,)
-    for n in xrange(o):
-        model += 'T(unreachable, "oExtra%s", istate)' % (n,)
-    modelcmd = "fmbt-gt -i model.lsts -o model.lsts --keep-labels 'P(istate, \"gt:istate\") -> %s'" % (model,)
-    s,o = commands.getstatusoutput(modelcmd)
-    if s != 0:
-        raise Exception("teststeps.py: fmbt-gt error, try: \"%s\"" % (modelcmd,))
+    parts = ['T(unreachable, "iExtra%s", istate)' % (n,) for n in range(i)]
+    parts += ['T(unreachable, "oExtra%s", istate)' % (n,) for n in range(o)]
+    model = ''.join(parts)
+    modelcmd = ["fmbt-gt", "-i", "model.lsts", "-o", "model.lsts", "--keep-labels",
+                'P(istate, "gt:istate") -> %s' % (model,)]
+    r = subprocess.run(modelcmd, capture_output=True, text=True)
+    if r.returncode != 0:
+        raise Exception("teststeps.py: fmbt-gt error, try: %s\n%s" % (
+            shlex.join(modelcmd), r.stderr))
 
 def iHeur(heuristics):
     """
@@ -53,5 +55,5 @@ def iEnd(end_condition):
 def iRun(expected_verdict):
     testconf_contents.append('on_fail = "exit:10"')
     testconf_contents.append('on_inconc = "exit:11"')
-    file("test.conf", "w").write('\n'.join(testconf_contents))
+    open("test.conf", "w").write('\n'.join(testconf_contents))
     # Todo: check that we'll get the expected verdict